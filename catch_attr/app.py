@@ -26,7 +26,13 @@ from rooting_depth import DepthMapper, root_depth_50_99_stats
 from topo_elev import elev_mean, slope_mean, merge_and_reproject_dems
 from topo_shape import basin_topo_stats
 from modis import summary_year
-from utils import absolute_file_paths, reproject_tif, shp_id, zonal_stats_singletif
+from utils import (
+    absolute_file_paths,
+    non_overlapping_groups,
+    reproject_tif,
+    shp_id,
+    zonal_mean_bulk,
+)
 from soil import binary2tif, tif_from_nc, all_soil_depth_mean_weight_in_soilgrids250
 from permeability_porosity import GLHYMPS
 
@@ -363,19 +369,33 @@ def soil_app():
     files = [x for x in absolute_file_paths(soil_source_dir) if x.endswith(".tif")]
     shapefiles_dir = os.path.join(definitions.DATASET_DIR, "shapefiles")
     shps = [x for x in absolute_file_paths(shapefiles_dir) if x.endswith(".shp")]
+    if len(shps) == 0:
+        raise FileNotFoundError("Please put your basin shapefiles to data/shapefiles")
+    # one polygon per basin, so that each tif is rasterized and aggregated only once
+    basin_gdfs = [gpd.read_file(shp) for shp in shps]
+    crs = basin_gdfs[0].crs
+    basins = gpd.GeoDataFrame(
+        geometry=[gdf.to_crs(crs).union_all() for gdf in basin_gdfs],
+        index=[shp_id(shp) for shp in shps],
+        crs=crs,
+    )
+    # nested or overlapping basins can't share one label raster, so they are rasterized in separate groups
+    basin_groups = non_overlapping_groups(basins)
     for file in files:
         if not ("_downscaled" in file):
             continue
         try:
-            for shp in shps:
-                if not shp_id(shp) in res:
-                    res[shp_id(shp)] = {}
-                var_name = (
-                    os.path.basename(file).split(".")[0].replace("_downscaled", "")
-                )
-                res[shp_id(shp)][var_name] = zonal_stats_singletif(
-                    file, shp, valid_min=0, valid_max=None
-                )
+            var_name = os.path.basename(file).split(".")[0].replace("_downscaled", "")
+            basin_means = pd.concat(
+                [
+                    zonal_mean_bulk(file, group, valid_min=0, valid_max=None)
+                    for group in basin_groups
+                ]
+            )
+            for basin_id, value in basin_means.items():
+                if not basin_id in res:
+                    res[basin_id] = {}
+                res[basin_id][var_name] = value
         except Exception as e:
             print(e)
             continue
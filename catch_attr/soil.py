@@ -1,8 +1,10 @@
-import cv2
+import math
+import re
+
 import netCDF4
 import numpy as np
 import pandas as pd
-import xarray
+from numba import njit
 
 from utils import *
 
@@ -69,7 +71,22 @@ range mapping might be needed if you are processing multiple variable simultaneo
 """
 
 
-def read_nc_data(ncfile: str):
+# tiled and compressed output, so that windowed reads for basins don't need to read full scanlines;
+# PREDICTOR=3 is the floating point predictor
+TIF_CREATION_OPTIONS = (
+    "TILED=YES",
+    "BLOCKXSIZE=512",
+    "BLOCKYSIZE=512",
+    "COMPRESS=DEFLATE",
+    "PREDICTOR=3",
+    "NUM_THREADS=ALL_CPUS",
+)
+
+# HDF5 chunk cache size in bytes for the variables read from netCDF files, released when the file is closed
+NC_CHUNK_CACHE_SIZE = 256 * 1024 * 1024
+
+
+def read_nc_data(ncfile: str, variables: list = None, first_layer: bool = False):
     """
     Read .nc data and return two dictionaries. The first dictionary contains variable names and variables,
     and the second dictionary contains descriptions of the variable names
@@ -77,6 +94,8 @@ def read_nc_data(ncfile: str):
     Parameters
     ----------
     ncfile: The path of the .nc file
+    variables: names of the variables to read; default is None which means all variables
+    first_layer: if True, only the first layer of 3-D variables is read from disk
 
     Returns
     -------
@@ -88,59 +107,144 @@ def read_nc_data(ncfile: str):
     try:
         with netCDF4.Dataset(ncfile) as file:
             file.set_auto_mask(False)
-            variables = {x: file[x][()] for x in file.variables}
-        with xarray.open_dataset(ncfile) as file:
+            var_names = list(file.variables) if variables is None else variables
+            data = {}
+            for x in var_names:
+                if (
+                    variables is not None
+                    and file.data_model.startswith("NETCDF4")
+                    and file[x].chunking() != "contiguous"
+                ):
+                    # a larger chunk cache for the requested variables avoids decompressing chunks repeatedly;
+                    # it is only available for chunked variables in netCDF-4 files
+                    file[x].set_var_chunk_cache(NC_CHUNK_CACHE_SIZE, 1009, 0.75)
+                if first_layer and file[x].ndim == 3:
+                    data[x] = file[x][0]
+                else:
+                    data[x] = file[x][()]
             longnames = {}
-            for x in file.variables:
-                if "longname" in file[x].attrs:
+            for x in var_names:
+                if "longname" in file[x].ncattrs():
                     longnames[x] = file[x].longname
                 else:
                     longnames[x] = file[x].long_name
             units = {}
-            for x in file.variables:
-                if "units" in file[x].attrs:
+            for x in var_names:
+                if "units" in file[x].ncattrs():
                     units[x] = file[x].units
-        return variables, longnames, units
+        return data, longnames, units
 
     except IOError:
         print(f"File corrupted: {ncfile}")
 
 
 def nc_var_description(ncfile: str):
-    return read_nc_data(ncfile)[1]
+    """
+    Get descriptions of all variables in a .nc file without reading any data
 
+    Parameters
+    ----------
+    ncfile: The path of the .nc file
 
-def tif_from_array(mag_grid: np.array, output_file: str):
+    Returns
+    -------
+    dict
+        {variable name: description}
+    """
+    with netCDF4.Dataset(ncfile) as file:
+        return {
+            x: getattr(file[x], "longname", getattr(file[x], "long_name", ""))
+            for x in file.variables
+        }
+
+
+@njit(cache=True)
+def _stats(a: np.array):
+    """
+    Min, max, mean and standard deviation of an array computed in one pass; NaN values are skipped
+    """
+    mn = np.inf
+    mx = -np.inf
+    s = 0.0
+    s2 = 0.0
+    n = 0
+    for v in a.ravel():
+        if np.isnan(v):
+            continue
+        if v < mn:
+            mn = v
+        if v > mx:
+            mx = v
+        s += v
+        s2 += v * v
+        n += 1
+    if n == 0:
+        return np.nan, np.nan, np.nan, np.nan
+    mean = s / n
+    return float(mn), float(mx), mean, math.sqrt(max(s2 / n - mean * mean, 0.0))
+
+
+def _write_tiles(outband, mag_grid: np.array, tile_size: int = 512):
+    """
+    Write an array to a raster band tile by tile, so GDAL only copies one tile at a time
+    """
+    ysize, xsize = mag_grid.shape
+    for y in range(0, ysize, tile_size):
+        for x in range(0, xsize, tile_size):
+            outband.WriteArray(mag_grid[y : y + tile_size, x : x + tile_size], x, y)
+
+
+def tif_from_array(
+    mag_grid: np.array, output_file: str, creation_options=TIF_CREATION_OPTIONS
+):
     """
     For data from:
     Dai, Y., Q. Xin, N. Wei, Y. Zhang, W. Shangguan, H. Yuan, S. Zhang, S. Liu, and X. Lu (2019b),
     A global high-resolution dataset of soil hydraulic and thermal properties for land surface modeling,
     J. Adv. Model. Earth System, accepted.
+
+    Parameters
+    ----------
+    mag_grid
+        the 1/12 degree global grid to be written to the tif file
+    output_file
+        path of the output tif file
+    creation_options
+        GDAL GTiff creation options; default is tiled and DEFLATE compressed
     """
-    lats = np.arange(-90, 90, 0.08333333333333333)
-    lons = np.arange(-180, 180, 0.08333333333333333)
-    xres = lons[1] - lons[0]
-    yres = lats[1] - lats[0]
-    ysize = len(lats)
-    xsize = len(lons)
+    mag_grid = np.asarray(mag_grid, dtype=np.float32)
+    # the grid is fixed by the data source: 1/12 degree, global
+    xres = 1 / 12
+    yres = 1 / 12
+    ysize = 2160
+    xsize = 4320
+    if mag_grid.shape != (ysize, xsize):
+        raise ValueError(
+            f"The grid should have shape {(ysize, xsize)}, but got {mag_grid.shape}"
+        )
     ulx = -180
     uly = -90
     driver = gdal.GetDriverByName("GTiff")
-    ds = driver.Create(output_file, xsize, ysize, 1, gdal.GDT_Float32)
+    ds = driver.Create(
+        output_file, xsize, ysize, 1, gdal.GDT_Float32, options=list(creation_options)
+    )
     srs = osr.SpatialReference()
     srs.ImportFromEPSG(4326)
     ds.SetProjection(srs.ExportToWkt())
     gt = [ulx, xres, 0, uly, 0, yres]
     ds.SetGeoTransform(gt)
     outband = ds.GetRasterBand(1)
-    outband.SetStatistics(
-        np.min(mag_grid), np.max(mag_grid), np.average(mag_grid), np.std(mag_grid)
-    )
-    outband.WriteArray(mag_grid)
+    outband.SetStatistics(*_stats(mag_grid))
+    _write_tiles(outband, mag_grid)
     ds = None
 
 
-def tif_from_nc(ncfile: str, variable_key: str, output_file: str):
+def tif_from_nc(
+    ncfile: str,
+    variable_key: str,
+    output_file: str,
+    creation_options=TIF_CREATION_OPTIONS,
+):
     """
     Convert a variable of the .nc file to a tif file.
 
@@ -158,38 +262,79 @@ def tif_from_nc(ncfile: str, variable_key: str, output_file: str):
         The variable name of the .nc file to be written to the tif file
     output_file
         path of the output tif file
+    creation_options
+        GDAL GTiff creation options; default is tiled and DEFLATE compressed
     """
 
-    variables = read_nc_data(ncfile)[0]
-    desc = read_nc_data(ncfile)[1]
+    # Only count the first layer, which is sliced when reading so other layers are not decompressed
+    variables, longnames, units = read_nc_data(
+        ncfile, variables=[variable_key], first_layer=True
+    )
     target_variable = variables[variable_key]
-    if len(target_variable.shape) == 3:
-        target_variable = target_variable[0]  # Only count the first layer
-    mag_grid = np.float64(target_variable)
-    lats = np.arange(18.004168, 53.995834, 0.008331404166666667)
-    lons = np.arange(73.004166, 135.99583, 0.0083333)
-
-    xres = lons[1] - lons[0]
-    yres = lats[1] - lats[0]
-    ysize = len(lats)
-    xsize = len(lons)
+    # the band is written as float32, so there is no need to work in float64
+    mag_grid = np.asarray(target_variable, dtype=np.float32)
+    # the grid is fixed by the data source: 30 arc-second, China
+    xres = 0.0083333
+    yres = 0.008331404166666667
+    ysize = 4320
+    xsize = 7560
+    if mag_grid.shape != (ysize, xsize):
+        raise ValueError(
+            f"The grid should have shape {(ysize, xsize)}, but got {mag_grid.shape}"
+        )
     ulx = 73.004166
     uly = 18.004168
     driver = gdal.GetDriverByName("GTiff")
-    ds = driver.Create(output_file, xsize, ysize, 1, gdal.GDT_Float32)
+    ds = driver.Create(
+        output_file, xsize, ysize, 1, gdal.GDT_Float32, options=list(creation_options)
+    )
     srs = osr.SpatialReference()
     srs.ImportFromEPSG(4326)
     ds.SetProjection(srs.ExportToWkt())
     gt = [ulx, xres, 0, uly, 0, yres]
     ds.SetGeoTransform(gt)
     outband = ds.GetRasterBand(1)
-    outband.SetStatistics(
-        np.min(mag_grid), np.max(mag_grid), np.average(mag_grid), np.std(mag_grid)
-    )
-    outband.WriteArray(mag_grid)
+    outband.SetStatistics(*_stats(mag_grid))
+    _write_tiles(outband, mag_grid)
     ds = None
 
 
+def binary_block_mean(file, nrows: int = 21600, ncols: int = 43200, block: int = 10):
+    """
+    Downsample a float64 binary grid by averaging every block x block cells
+
+    The minimum value of the grid is regarded as nodata and not counted; blocks without valid cells are -9999.
+
+    Parameters
+    ----------
+    file
+        /path/to/binary
+    nrows
+        number of rows of the binary grid, which begins from the north
+    ncols
+        number of columns of the binary grid
+    block
+        number of cells in each direction averaged into one cell
+
+    Returns
+    -------
+    np.array
+        float32 downsampled grid whose rows begin from the south
+    """
+    # map the file rather than loading the whole ~7.5 GB grid into memory
+    data = np.memmap(file, dtype=np.float64, mode="r", shape=(nrows, ncols))
+    nodata = data.min()
+    data_rs = np.empty((nrows // block, ncols // block), dtype=np.float32)
+    for i in range(nrows // block):
+        strip = np.ma.masked_equal(data[i * block : (i + 1) * block], nodata)
+        # rows of the source data begin from the north, while tif_from_array starts from the south
+        data_rs[-1 - i] = (
+            strip.reshape(block, ncols // block, block).mean(axis=(0, 2)).filled(-9999)
+        )
+    del data
+    return data_rs
+
+
 def binary2tif(file, out_path):
     """
     Parameters
@@ -203,12 +348,8 @@ def binary2tif(file, out_path):
     -------
     None
     """
-
-    data = np.fromfile(file, dtype=np.float64).reshape((21600, 43200))
-    data[data == data.min()] = -9999
-    tif_from_array(
-        cv2.flip(np.rot90(cv2.resize(data, (43200 // 10, 21600 // 10)), 2), 1), out_path
-    )
+    # average every 10x10 block of valid cells to get the 1/12 degree grid
+    tif_from_array(binary_block_mean(file), out_path)
 
 
 def all_soil_depth_mean_weight_in_soilgrids250(attr_df: pd.DataFrame):
@@ -228,19 +369,33 @@ def all_soil_depth_mean_weight_in_soilgrids250(attr_df: pd.DataFrame):
         Soil attr value average over all layers in a basin
     """
     all_cols = attr_df.columns.values
-    cols = [col.split("_")[0] for col in all_cols if "sl1" in col]
+    cols = list(dict.fromkeys(col.split("_")[0] for col in all_cols if "sl1" in col))
     soil_depths = np.array([0, 5, 15, 30, 60, 100, 200])
-    heights = soil_depths[1:] - soil_depths[:-1]
+    heights = (soil_depths[1:] - soil_depths[:-1]).astype(float)
+    col_lists = []
     for i in range(len(cols)):
-        attr_ = attr_df.filter(regex=cols[i])
-        all_numbers = np.zeros(attr_.shape)
-        mean_value = np.zeros(attr_.shape[0])
-        # to guarantee the sequence is correct, we use a loop rather than apply function
-        for j in range(1, 8):
-            all_numbers[:, j - 1] = attr_.filter(regex="sl" + str(j)).values.flatten()
-        for k in range(len(mean_value)):
-            mean_value[k] = (
-                np.sum(heights * (all_numbers[k, :-1] + all_numbers[k, 1:]) / 2) / 200
-            )
-        attr_df[cols[i]] = mean_value
+        # to guarantee the sequence is correct, we order the columns by depth explicitly
+        col_list = [f"{cols[i]}_sl{j}" for j in range(1, 8)]
+        if not set(col_list).issubset(all_cols):
+            # names such as SNDPPT_M_sl1_250m have extra parts around the depth tag
+            depth_cols = {}
+            for col in all_cols:
+                match = re.match(rf"^{re.escape(cols[i])}_.*sl(\d)", col)
+                if match is not None:
+                    depth_cols[int(match.group(1))] = col
+            col_list = [depth_cols.get(j) for j in range(1, 8)]
+        if None in col_list or len(col_list) != len(soil_depths):
+            raise ValueError(f"{cols[i]} should have values in 7 soil depths sl1-sl7")
+        col_lists.append(col_list)
+    if len(col_lists) == 0:
+        return attr_df
+    # (basin, attribute, depth) values of all attributes, averaged over depths in one batch
+    all_numbers = np.stack(
+        [attr_df.loc[:, col_list].to_numpy(dtype=np.float64) for col_list in col_lists],
+        axis=1,
+    )
+    # trapezoidal rule over depth intervals
+    layer_sums = all_numbers[:, :, :-1] + all_numbers[:, :, 1:]
+    mean_all = (layer_sums * heights).sum(axis=-1) / 400.0
+    attr_df[cols] = pd.DataFrame(mean_all, index=attr_df.index, columns=cols)
     return attr_df
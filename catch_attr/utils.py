@@ -1,11 +1,17 @@
+import math
 import os
 import re
 import numpy as np
+import pandas as pd
+import scipy.ndimage
 from osgeo import gdal, osr
 
 import fiona
 import rasterio
+import rasterio.features
 import rasterio.mask
+import rasterio.transform
+import rasterio.windows
 from rasterio.merge import merge
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 
@@ -258,3 +264,104 @@ def zonal_stats_singletif(
         return np.mean(res)
     else:
         return np.nan
+
+
+def non_overlapping_groups(basins_gdf) -> list:
+    """
+    Split basins into groups in which no two basins overlap, e.g. nested catchments are put in different groups
+
+    Basins which only touch each other on their boundaries are not regarded as overlapping.
+
+    Parameters
+    ----------
+    basins_gdf
+        GeoDataFrame with one polygon per basin
+
+    Returns
+    -------
+    list
+        GeoDataFrames of the groups; most basins fall in the first group
+    """
+    geoms = basins_gdf.geometry.values
+    group_of = np.full(len(geoms), -1)
+    n_groups = 0
+    for i, geom in enumerate(geoms):
+        conflicts = set()
+        for j in basins_gdf.sindex.query(geom, predicate="intersects"):
+            if j < i and geom.intersection(geoms[j]).area > 0:
+                conflicts.add(group_of[j])
+        group = next(g for g in range(n_groups + 1) if g not in conflicts)
+        n_groups = max(n_groups, group + 1)
+        group_of[i] = group
+    return [basins_gdf[group_of == g] for g in range(n_groups)]
+
+
+def zonal_mean_bulk(
+    raster_path: str, basins_gdf, valid_min=None, valid_max=None, nodata=-9999
+) -> pd.Series:
+    """
+    Make zonal statistics of one .tif file for all basins at once
+
+    All polygons are rasterized once into a label raster, and then the mean value of every label is
+    calculated in one pass, which is much faster than masking the raster for each basin one by one.
+    Notice: a pixel only belongs to one basin in the label raster, so for overlapping polygons
+    the shared pixels are only counted for the basin which comes later in basins_gdf; split overlapping
+    basins with non_overlapping_groups first.
+
+    Parameters
+    ----------
+    raster_path
+        EPSG:4326 .tif file path
+    basins_gdf
+        EPSG:4326 GeoDataFrame with one polygon per basin
+    valid_min
+        values less than or equal to it are ignored; default is None
+    valid_max
+        values greater than or equal to it are ignored; default is None
+    nodata
+        nodata's value; default is -9999
+
+    Returns
+    -------
+    pd.Series
+        zonal statistics of each basin, indexed as basins_gdf; NaN for basins without valid pixels
+    """
+    with rasterio.open(raster_path) as src:
+        # only read the window covering all basins; rows of the corners are compared rather than
+        # assumed in order, so that both north-up and south-up rasters work
+        minx, miny, maxx, maxy = basins_gdf.total_bounds
+        rows, cols = rasterio.transform.rowcol(
+            src.transform, [minx, maxx, maxx, minx], [maxy, maxy, miny, miny], op=float
+        )
+        row_start, col_start = math.floor(min(rows)), math.floor(min(cols))
+        window = rasterio.windows.Window(
+            col_start,
+            row_start,
+            math.ceil(max(cols)) - col_start,
+            math.ceil(max(rows)) - row_start,
+        )
+        full_window = rasterio.windows.Window(0, 0, src.width, src.height)
+        if not rasterio.windows.intersect([window, full_window]):
+            # basins are all outside the raster
+            return pd.Series(np.nan, index=basins_gdf.index)
+        window = window.intersection(full_window)
+        data = src.read(1, window=window)
+        transform = src.window_transform(window)
+    labels = rasterio.features.rasterize(
+        ((geom, i + 1) for i, geom in enumerate(basins_gdf.geometry)),
+        out_shape=data.shape,
+        transform=transform,
+        fill=0,
+        dtype="int32",
+    )
+    valid = (data != nodata) & ~np.isnan(data)
+    if valid_min is not None:
+        valid &= data > valid_min
+    if valid_max is not None:
+        valid &= data < valid_max
+    labels[~valid] = 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = scipy.ndimage.mean(
+            data, labels=labels, index=np.arange(1, len(basins_gdf) + 1)
+        )
+    return pd.Series(means, index=basins_gdf.index)
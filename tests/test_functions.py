@@ -1,7 +1,13 @@
 import os
+import sys
 import numpy as np
 import pandas as pd
 import pytest
+import netCDF4
+import geopandas as gpd
+import rasterio
+from affine import Affine
+from shapely.geometry import box
 
 from catch_attr.climate import (
     series_mean,
@@ -16,6 +22,16 @@ from catch_attr.climate import (
 
 import definitions
 from catch_attr.basin_era5_process import utc_to_local, trans_era5_land_to_camels_format
+from catch_attr.utils import non_overlapping_groups, zonal_mean_bulk
+
+# soil.py imports utils as a top-level module, as app.py does
+sys.path.append(os.path.join(definitions.ROOT_DIR, "catch_attr"))
+from soil import (
+    _stats,
+    all_soil_depth_mean_weight_in_soilgrids250,
+    binary_block_mean,
+    read_nc_data,
+)
 
 
 @pytest.fixture
@@ -92,3 +108,134 @@ def test_low_prec_timing(forcing_data):
 def test_frac_snow_daily(forcing_data):
     frac_snow_daily_ = frac_snow_daily(forcing_data)
     assert frac_snow_daily_ == 0.4106374657802112
+
+
+def test_binary_block_mean(tmp_path):
+    data = np.arange(24, dtype=np.float64).reshape(4, 6) + 1
+    data[0, 0] = -1
+    data[2:, 4:] = -1
+    binary_file = os.path.join(tmp_path, "soil.bin")
+    data.tofile(binary_file)
+    data_rs = binary_block_mean(binary_file, nrows=4, ncols=6, block=2)
+    expected = np.zeros((2, 3))
+    for i in range(2):
+        for j in range(3):
+            block = data[i * 2 : (i + 1) * 2, j * 2 : (j + 1) * 2]
+            block = block[block != -1]
+            expected[i, j] = block.mean() if len(block) > 0 else -9999
+    assert data_rs.dtype == np.float32
+    # rows begin from the south after downsampling
+    np.testing.assert_allclose(data_rs, expected[::-1], rtol=1e-6)
+
+
+@pytest.fixture
+def soil_depth_data():
+    rng = np.random.default_rng(0)
+    sand = rng.uniform(0, 100, size=(4, 7))
+    clay = rng.uniform(0, 100, size=(4, 7))
+    clay[2, 3] = np.nan
+    df = pd.DataFrame({"gage_id": ["0000", "0001", "0002", "0003"]})
+    for j in range(1, 8):
+        # SoilGrids file names, which need the regex fallback to find the depth
+        df[f"SNDPPT_M_sl{j}_250m"] = sand[:, j - 1]
+        df[f"CLYPPT_sl{j}"] = clay[:, j - 1]
+    return df, sand, clay
+
+
+def test_all_soil_depth_mean_weight_in_soilgrids250(soil_depth_data):
+    df, sand, clay = soil_depth_data
+    res = all_soil_depth_mean_weight_in_soilgrids250(df)
+    heights = np.array([5, 10, 15, 30, 40, 100])
+    for col, values in [("SNDPPT", sand), ("CLYPPT", clay)]:
+        expected = [np.sum(heights * (row[:-1] + row[1:]) / 2) / 200 for row in values]
+        np.testing.assert_allclose(res[col].values, expected)
+    assert np.isnan(res["CLYPPT"].values[2])
+
+
+def test_all_soil_depth_mean_missing_depth(soil_depth_data):
+    df = soil_depth_data[0].drop(columns=["CLYPPT_sl7"])
+    with pytest.raises(ValueError):
+        all_soil_depth_mean_weight_in_soilgrids250(df)
+
+
+def write_test_tif(tif_file, data, transform):
+    with rasterio.open(
+        tif_file,
+        "w",
+        driver="GTiff",
+        height=data.shape[0],
+        width=data.shape[1],
+        count=1,
+        dtype="float32",
+        crs="EPSG:4326",
+        transform=transform,
+    ) as dst:
+        dst.write(data, 1)
+
+
+@pytest.mark.parametrize("north_up", [True, False])
+def test_zonal_mean_bulk(tmp_path, north_up):
+    # rows begin from the north, covering x in [10, 14] and y in [10, 14]
+    data = np.arange(16, dtype=np.float32).reshape(4, 4)
+    data[3, 3] = -9999
+    tif_file = os.path.join(tmp_path, "test.tif")
+    if north_up:
+        write_test_tif(tif_file, data, Affine(1, 0, 10, 0, -1, 14))
+    else:
+        # same layout as tif_from_array: origin at the south-west corner and positive y resolution
+        write_test_tif(tif_file, data[::-1].copy(), Affine(1, 0, 10, 0, 1, 10))
+    basins = gpd.GeoDataFrame(
+        geometry=[box(10, 12, 12, 14), box(12, 10, 14, 12)],
+        index=["0000", "0001"],
+        crs="EPSG:4326",
+    )
+    res = zonal_mean_bulk(tif_file, basins)
+    np.testing.assert_allclose(res.values, [2.5, (10 + 11 + 14) / 3])
+    assert list(res.index) == ["0000", "0001"]
+    outside = gpd.GeoDataFrame(
+        geometry=[box(20, 20, 21, 21)], index=["0002"], crs="EPSG:4326"
+    )
+    assert np.isnan(zonal_mean_bulk(tif_file, outside).values).all()
+
+
+def test_non_overlapping_groups():
+    basins = gpd.GeoDataFrame(
+        geometry=[box(0, 0, 4, 4), box(0, 0, 2, 2), box(4, 0, 6, 2)],
+        index=["outer", "inner", "neighbor"],
+        crs="EPSG:4326",
+    )
+    groups = non_overlapping_groups(basins)
+    assert [list(group.index) for group in groups] == [["outer", "neighbor"], ["inner"]]
+
+
+def test_stats_skip_nan():
+    data = np.random.default_rng(0).uniform(-10, 10, size=(6, 8)).astype(np.float32)
+    data[1, 2] = np.nan
+    data[4, 5] = np.nan
+    # a non-contiguous slice, like the reversed rows written by binary2tif
+    for grid in [data, data[::-1, ::2]]:
+        expected = [np.nanmin(grid), np.nanmax(grid), np.nanmean(grid), np.nanstd(grid)]
+        np.testing.assert_allclose(_stats(grid), expected, rtol=1e-5)
+    assert np.isnan(_stats(np.full((2, 3), np.nan, dtype=np.float32))).all()
+
+
+@pytest.mark.parametrize("nc_format", ["NETCDF3_CLASSIC", "NETCDF4"])
+def test_read_nc_data_first_layer(tmp_path, nc_format):
+    data = np.arange(24, dtype=np.float32).reshape(2, 3, 4)
+    nc_file = os.path.join(tmp_path, "soil.nc")
+    with netCDF4.Dataset(nc_file, "w", format=nc_format) as file:
+        file.createDimension("layer", 2)
+        file.createDimension("lat", 3)
+        file.createDimension("lon", 4)
+        # the chunk cache is only set for chunked netCDF-4 variables
+        zlib = nc_format == "NETCDF4"
+        sand = file.createVariable("SA", "f4", ("layer", "lat", "lon"), zlib=zlib)
+        sand.long_name = "Sand content"
+        sand.units = "%"
+        sand[:] = data
+    variables, longnames, units = read_nc_data(
+        nc_file, variables=["SA"], first_layer=True
+    )
+    np.testing.assert_array_equal(variables["SA"], data[0])
+    assert longnames == {"SA": "Sand content"}
+    assert units == {"SA": "%"}